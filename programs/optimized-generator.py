@@ -1,73 +1,109 @@
 import clingo
 import secrets
+from dataclasses import dataclass, field
+from pathlib import Path
 
-facts = []
-seed = None
+# Text of the program files, keyed by their resolved path, with the
+# modification time they were read at.
+_program_texts = {}
 PATH = "./"
 
-def collect_model(model):
-    global facts
-    facts.extend([str(atom) + "." for atom in model.symbols(atoms=True)])
+# Predicates of the generated instance that are given to the solvers.
+SOLVER_PREDICATES = frozenset(["width", "height", "depth", "block", "pipe", "pipe_in", "pipe_out"])
+SOLVER_WITHOUT_PIPES_PREDICATES = frozenset(["width", "height", "depth", "block"])
+
+@dataclass
+class GeneratorSession:
+    # The atoms of the previous steps, as the keys of a dict to drop the
+    # duplicates while keeping their order.
+    facts: dict = field(default_factory=dict)
+    seed: int = 0
+
+    def collect_model(self, model):
+        self.facts.update(dict.fromkeys(model.symbols(atoms=True)))
+
+def load_program(ctl: clingo.Control, program):
+    # The program files are only read again when they change, and are
+    # added as text to every new control instead of being loaded from disk.
+    path = Path(program).resolve()
+    mtime = path.stat().st_mtime_ns
+    cached = _program_texts.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, path.read_text())
+        _program_texts[path] = cached
+    ctl.add("base", [], cached[1])
+
+def add_facts(ctl: clingo.Control, atoms):
+    with ctl.backend() as backend:
+        for atom in atoms:
+            backend.add_rule([backend.add_atom(atom)])
 
 def print_model(model: clingo.Model):
-    model_str = [atom for atom in str(model).split(" ")]
-    print(" ".join(model_str))
+    print(" ".join(str(atom) for atom in model.symbols(shown=True)))
 
-def solve_step(program, step, rand_freq=1.0, parallel=11, last=False, parameters=None):
+def solve_step(session, program, step, rand_freq=1.0, parallel=11, last=False, parameters=None):
     if parameters is None:
         parameters = []
 
-    ctl = clingo.Control(["--rand-freq=" + str(rand_freq), "-t " + str(parallel), f"--seed={str(seed)}"] + parameters)
-    ctl.load(program)
-    ctl.add("facts", [], "\n".join(facts))
-    ctl.ground([("facts", []), (step, [])])
+    ctl = clingo.Control([f"--rand-freq={rand_freq}", "-t", str(parallel), f"--seed={session.seed}"] + parameters)
+    load_program(ctl, program)
+
+    # The atoms of the previous steps are added as ground facts
+    # through the backend, so they do not need to be parsed again.
+    add_facts(ctl, session.facts)
+
+    ctl.ground([(step, [])])
 
     if last:
         ctl.solve(on_model=print_model)
     else:
-        ctl.solve(on_model=collect_model)
+        ctl.solve(on_model=session.collect_model)
 
-def run_generator(height, width, depth, print=False):
-    global facts
-    facts = []
+def run_generator(height, width, depth, print=False, parallel=11):
+    session = GeneratorSession(seed=secrets.randbelow(2**31))
     program = f"{PATH}optimized-generator.lp"
-    global seed
-    seed = secrets.randbelow(2**31)
-
-    solve_step(program, "block_size_gen", rand_freq=1, parallel=1, parameters=["-c h=" +str(height), "-c w=" + str(width), "-c d=" + str(depth)])
-    solve_step(program, "block_gen", rand_freq=0.5, parallel=11)
-    solve_step(program, "pipe_gen", rand_freq=1, parallel=11)
-    solve_step(program, "rotation", rand_freq=1, parallel=11, last=print)
-
-def run_solver(print=False):
-    program = f"{PATH}solver.lp"
-    filter = ["width", "height", "depth", "block", "pipe", "pipe_in", "pipe_out"]
-    filtered = [item for item in facts if any(item.startswith(f"{f}(") for f in filter)]
-
-    ctl = clingo.Control(["-t 11"])
-    ctl.load(program)
-    ctl.add("facts", [], "\n".join(filtered))
-    ctl.ground([("facts", []), ("base", [])])
 
+    # Each step only needs one model. A small random frequency lets clasp use its
+    # learned heuristics, the varying seed is enough to get different puzzles.
+    parameters = ["--configuration=trendy", "--models=1"]
+
+    solve_step(session, program, "block_size_gen", rand_freq=1, parallel=1, parameters=parameters + ["-c", f"h={height}", "-c", f"w={width}", "-c", f"d={depth}"])
+    solve_step(session, program, "block_gen", rand_freq=0.05, parallel=parallel, parameters=parameters)
+    solve_step(session, program, "pipe_gen", rand_freq=0.05, parallel=parallel, parameters=parameters)
+    solve_step(session, program, "rotation", rand_freq=0.05, parallel=parallel, last=print, parameters=parameters)
+    return session
+
+def prepare_solver(session, program="solver.lp", predicates=SOLVER_PREDICATES, parallel=11):
+    filtered = [item for item in session.facts if item.name in predicates]
+
+    # The learned nogoods and heuristic scores are forgotten before every solve,
+    # so repeated solves do not start from what the previous ones learned. They
+    # still reuse the preprocessed program, which only the first solve pays for.
+    ctl = clingo.Control(["-t", str(parallel), "--forget-on-step=varScores,signs,lemmaScores,lemmas"])
+    load_program(ctl, f"{PATH}{program}")
+    add_facts(ctl, filtered)
+    ctl.ground([("base", [])])
+    return ctl
+
+def solve(ctl, print=False):
     if print:
         ctl.solve(on_model=print_model)
     else:
         ctl.solve()
 
-def run_solver_without_pipes(print=False):
-    program = f"{PATH}solver-without-pipes.lp"
-    filter = ["width", "height", "depth", "block"]
-    filtered = [item for item in facts if any(item.startswith(f"{f}(") for f in filter)]
+def run_solver_once(ctl, print=False):
+    # Solves an already grounded instance again with a new seed.
+    seed = secrets.randbelow(2**31)
+    for solver in ctl.configuration.solver:
+        solver.seed = str(seed)
+    solve(ctl, print)
 
-    ctl = clingo.Control(["-t 11"])
-    ctl.load(program)
-    ctl.add("facts", [], "\n".join(filtered))
-    ctl.ground([("facts", []), ("base", [])])
+def run_solver(session, print=False, parallel=11):
+    solve(prepare_solver(session, parallel=parallel), print)
 
-    if print:
-        ctl.solve(on_model=print_model)
-    else:
-        ctl.solve()
+def run_solver_without_pipes(session, print=False, parallel=11):
+    ctl = prepare_solver(session, "solver-without-pipes.lp", SOLVER_WITHOUT_PIPES_PREDICATES, parallel)
+    solve(ctl, print)
 
 import argparse
 
@@ -104,5 +140,5 @@ if __name__ == "__main__":
     width = args.width
     depth = args.depth
 
-    run_generator(height, width, depth, print=False)
-    run_solver(print=True)
+    session = run_generator(height, width, depth, print=False)
+    run_solver(session, print=True)